@@ -0,0 +1,54 @@
+require 'formula'
+require 'json'
+
+class IucPackageblastplus2231 < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://testtoolshed.g2.bx.psu.edu/iuc/package_blast_plus_2_2_31
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  if OS.mac? and !build.without?("architecture")
+    url "ftp://ftp.ncbi.nlm.nih.gov/blast/executables/blast+/2.2.31/ncbi-blast-2.2.31+-universal-macosx.tar.gz"
+    sha1 ""
+  elsif OS.linux? and Hardware.is_32_bit? and !build.without?("architecture")
+    url "ftp://ftp.ncbi.nlm.nih.gov/blast/executables/blast+/2.2.31/ncbi-blast-2.2.31+-ia32-linux.tar.gz"
+    sha1 ""
+  else
+    url "ftp://ftp.ncbi.nlm.nih.gov/blast/executables/blast+/2.2.31/ncbi-blast-2.2.31+-src.tar.gz"
+    sha1 ""
+  end
+  
+  if OS.mac? and !build.without?("architecture")
+  elsif OS.linux? and Hardware.is_32_bit? and !build.without?("architecture")
+  else
+  end
+  def install
+    if OS.mac? and !build.without?("architecture")
+      bin.install Dir["bin/*"]
+      # Tool Shed set environment variable that is picked implicitly.
+      environment([{'action'=> 'set', 'variable'=> 'BLAST_64', 'value'=> '#{Hardware.Hardware.is_64_bit?}'}])
+    elsif OS.linux? and Hardware.is_32_bit? and !build.without?("architecture")
+      bin.install Dir["bin/*"]
+      # Tool Shed set environment variable that is picked implicitly.
+      environment([{'action'=> 'set', 'variable'=> 'BLAST_64', 'value'=> '#{Hardware.Hardware.is_64_bit?}'}])
+    else
+      # Skipping set_environment_for_install command, handled by platform brew.
+      cd 'c++'
+      system "./configure --prefix=#{prefix} --with-64 --with-bin-release" 
+      system "make install"
+      prefix.install "README"
+      system "mkdir", "-p", "#{prefix}/share/doc"
+      mv Dir["doc/*"], "#{prefix}/share/doc" 
+      # Tool Shed set environment variable that is picked implicitly.
+      environment([{'action'=> 'set', 'variable'=> 'BLAST_64', 'value'=> '#{Hardware.Hardware.is_64_bit?}'}])
+    end
+  end
+  
+  def environment(actions)
+      # Setup envirnoment variable modifications that will be used later by
+      # platform-brew's env and vinstall commands.
+      act_hash = {"actions" => actions}
+      (prefix / "platform_environment.json").write act_hash.to_json
+  end
+  
+end
\ No newline at end of file
@@ -0,0 +1,35 @@
+require 'formula'
+
+class DevteamPackagesamtools0119 < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://toolshed.g2.bx.psu.edu/devteam/package_samtools_0_1_19
+  # Tool Shed Readme:
+  #    
+  #    Compiling SAMtools requires the ncurses and zlib development libraries.
+  #            
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  if OS.linux? and Hardware.is_64_bit? and !build.without?("architecture")
+    url "http://depot.galaxyproject.org/package/linux/x86_64/samtools/samtools-0.1.19-Linux-x86_64.tgz"
+    sha1 ""
+  else
+    url "http://downloads.sourceforge.net/project/samtools/samtools/0.1.19/samtools-0.1.19.tar.bz2"
+    sha1 ""
+  end
+  
+  if OS.linux? and Hardware.is_64_bit? and !build.without?("architecture")
+  else
+  end
+  def install
+    if OS.linux? and Hardware.is_64_bit? and !build.without?("architecture")
+      prefix.install Dir["./*"]
+      # Tool Shed set environment variable that is picked implicitly.
+    else
+      system "sed -i.bak -e 's/-lcurses/-lncurses/g' Makefile" 
+      system "make" 
+      bin.install "samtools"
+      # Tool Shed set environment variable that is picked implicitly.
+    end
+  end
+end
\ No newline at end of file
@@ -0,0 +1,31 @@
+require 'formula'
+require 'json'
+
+class IucPackagemultibwa < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://toolshed.g2.bx.psu.edu/iuc/package_multi
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  url "https://github.com/lh3/bwa/archive/0.7.12.tar.gz"
+  sha1 ""
+  
+  depends_on "jmchilton/toolshed/iuc_packagezlib128"
+  depends_on "jmchilton/toolshed/iuc_packagezlib128"
+  def install
+    system <<-EOF
+make
+cp bwa #{prefix}/bin
+EOF
+    # Tool Shed set environment variable that is picked implicitly.
+    environment([{'action'=> 'set', 'variable'=> 'BWA_ROOT', 'value'=> '$KEG_ROOT'}])
+  end
+  
+  def environment(actions)
+      # Setup envirnoment variable modifications that will be used later by
+      # platform-brew's env and vinstall commands.
+      act_hash = {"actions" => actions}
+      (prefix / "platform_environment.json").write act_hash.to_json
+  end
+  
+end
\ No newline at end of file
@@ -0,0 +1,37 @@
+require 'formula'
+require 'json'
+
+class IucPackagemultibwaExtras < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://toolshed.g2.bx.psu.edu/iuc/package_multi
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  url "https://example.org/extras-0.1.zip"
+  sha1 ""
+  resource 'data.tx' do
+    url "https://example.org/data.txt", :using => :nounzip
+    sha1 ""
+  end
+  
+  depends_on "jmchilton/toolshed/iuc_packagezlib128"
+  def install
+    environment_actions = []
+    resource('data.tx').stage do
+        # Tool Shed would download inside build directory instead of its own - so move download.
+        buildpath.install Dir["*"]
+    end
+    system "mkdir", "-p", "#{prefix}/share"
+    environment_actions += [{'action'=> 'set', 'variable'=> 'EXTRAS', 'value'=> '$KEG_ROOT/share'}]
+    environment_actions += [{'action'=> 'append', 'variable'=> 'EXTRAS_PATH', 'value'=> '$KEG_ROOT/share'}]
+    environment(environment_actions)
+  end
+  
+  def environment(actions)
+      # Setup envirnoment variable modifications that will be used later by
+      # platform-brew's env and vinstall commands.
+      act_hash = {"actions" => actions}
+      (prefix / "platform_environment.json").write act_hash.to_json
+  end
+  
+end
\ No newline at end of file
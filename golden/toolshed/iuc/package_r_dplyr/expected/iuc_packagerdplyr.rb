@@ -0,0 +1,29 @@
+require 'formula'
+require 'json'
+
+class IucPackagerdplyr < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://toolshed.g2.bx.psu.edu/iuc/package_r_dplyr
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  # Each homebrew formula must have at least one download, tool shed doesn't require this so hacking in hello source download.
+  url "http://ftpmirror.gnu.org/hello/hello-2.9.tar.gz"
+  sha1 "cb0470b0e8f4f7768338f5c5cfe1688c90fbbc74"
+  
+  depends_on "jmchilton/toolshed/iuc_packager312"
+  def install
+    onoe("Unhandled tool shed action R encountered.")
+    system "mkdir", "-p", "#{prefix}/lib"
+    onoe("Unhandled tool shed action [template_command] encountered.")
+    environment([{'action'=> 'prepend', 'variable'=> 'R_LIBS', 'value'=> '$KEG_ROOT'}])
+  end
+  
+  def environment(actions)
+      # Setup envirnoment variable modifications that will be used later by
+      # platform-brew's env and vinstall commands.
+      act_hash = {"actions" => actions}
+      (prefix / "platform_environment.json").write act_hash.to_json
+  end
+  
+end
\ No newline at end of file
@@ -0,0 +1,16 @@
+require 'formula'
+
+class IucPackagezlib128 < Formula
+  version "1.0"
+  # Recipe auto-generate from repository https://toolshed.g2.bx.psu.edu/iuc/package_zlib_1_2_8
+  
+  option "without-architecture", "Build without allowing architecture information (to force source install when binaries are available)."
+  
+  url "http://zlib.net/zlib-1.2.8.tar.gz"
+  sha1 ""
+  
+  def install
+    system "./configure --prefix=#{prefix}" 
+    system "make install"
+  end
+end
\ No newline at end of file
@@ -1,15 +1,34 @@
 #!/usr/bin/env python
+import collections
+import contextlib
+import difflib
+import errno
+import gc
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import re
+import shutil
 import traceback
 import string
 import subprocess
 import sys
-import urllib
+import tarfile
+import tempfile
+import threading
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree as ET
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import click
+import requests
 
 from bioblend import toolshed
 
@@ -20,10 +39,27 @@ TOOLSHED_MAP = {
     "testtoolshed": "https://testtoolshed.g2.bx.psu.edu",
 }
 GIT_USER = "jmchilton"
+JOURNAL_NAME = ".shed2tap_journal"
+FORMULA_INDEX_NAME = "formula_index.json"
+FORMULA_INDEX_VERSION = 1
+# (stage, status) pairs after which a repository needs no further work.
+JOURNAL_TERMINAL = frozenset([
+    ("fetch", "skipped"),
+    ("parse", "failed"),
+    ("render", "ok"),
+])
 if sys.platform == "darwin":
     DEFAULT_HOMEBREW_ROOT = "/usr/local"
 else:
     DEFAULT_HOMEBREW_ROOT = os.path.join(os.path.expanduser("~"), ".linuxbrew")
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".shed2tap", "cache")
+GOLDEN_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+CACHE_ARCHIVE_FORMAT = "shed2tap-cache"
+CACHE_ARCHIVE_VERSION = 1
+DEFAULT_STATS_NAME = "shed2tap_stats.json"
+MIRROR_SAVE_INTERVAL = 100
+# Repositories fetched, parsed, mirrored and rendered together.
+CONVERT_BATCH_SIZE = 50
 
 
 EXTENSION_ENVIRONMENT = """
@@ -59,77 +95,1286 @@ EXTENSION_PERL = """
 """
 
 
-@click.command()
-@click.option('--tool_shed', default="toolshed", type=click.Choice(TOOLSHED_MAP.keys()), help='Tool shed to target.')
+@click.group(invoke_without_command=True)
+@click.option('--tool_shed', default=["toolshed"], multiple=True, type=click.Choice(TOOLSHED_MAP.keys()), help='Tool shed to target (may be repeated).')
 @click.option('--owner', default=None, help='Limit generation to specific owner.')
 @click.option('--name_filter', default=None, help='Apply regex to name filters.')
+@click.option('--package', default=None, help='Only convert packages with this name.')
+@click.option('--version', default=None, help='Only convert packages with this version.')
 @click.option('--git_user', default="jmchilton")
 @click.option('--brew_directory', default=DEFAULT_HOMEBREW_ROOT)
-def main(**kwds):
+@click.option('--use_metadata/--no_use_metadata', default=True, help='Use batched tool shed repository metadata to skip repositories without tool dependencies.')
+@click.option('--resume', is_flag=True, default=False, help='Continue an interrupted run from its journal, skipping completed repositories.')
+@click.option('--crawl', is_flag=True, default=False, help='Also generate every repository referenced by the selected ones, transitively.')
+@click.option('--crawl_threads', default=8, type=int, help='Number of repositories fetched in parallel while crawling.')
+@click.option('--mirror_directory', default=None, help='Download every source tarball once into this content-addressed store.')
+@click.option('--mirror_url', default=None, help='Rewrite formula URLs to point at this public URL of the mirror directory.')
+@click.option('--mirror_threads', default=8, type=int, help='Number of parallel mirror downloads.')
+@click.option('--check_urls', is_flag=True, default=False, help='Check that every download URL is still alive (HEAD/range requests only).')
+@click.option('--dead_urls', default="annotate", type=click.Choice(["annotate", "skip"]), help='Annotate or skip formulas with dead download URLs.')
+@click.option('--url_report', default=None, help='Write a JSON report of the download URL check to this path.')
+@click.option('--check_threads', default=16, type=int, help='Number of parallel download URL checks.')
+@click.option('--check_host_limit', default=4, type=int, help='Maximum concurrent download URL checks per host.')
+@click.option('--check_ttl', default=86400, type=int, help='Seconds a cached download URL check result stays valid.')
+@click.option('--cache_directory', default=DEFAULT_CACHE_DIRECTORY, help='Directory caching fetched files and tool shed listings.')
+@click.option('--shard/--no_shard', default=None, help='Write formulas to Formula/<first letter>/ instead of the tap root (default: the layout of the existing tap).')
+@click.option('--listing_ttl', default=3600, type=int, help='Seconds a cached tool shed listing stays valid.')
+@click.option('--stats', default=None, help='Write per-stage timing statistics as JSON to this path.')
+@click.option('--profile_memory', is_flag=True, default=False, help='Also profile memory per stage, written next to the timing statistics.')
+@click.option('--profile_sample', default=100, type=int, help='Count live objects by type (a gc census) around every Nth call of a stage while profiling memory.')
+@click.pass_context
+def main(ctx, **kwds):
+    ctx.obj = kwds
+    if ctx.invoked_subcommand is not None:
+        return
+    taps = setup_taps(kwds)
+    for tap in taps.values():
+        tap.journal = Journal(os.path.join(tap.target, JOURNAL_NAME), resume=kwds["resume"])
+        if kwds["resume"]:
+            for entry in tap.journal.entries.values():
+                tap.index.update(entry.get("formulas", {}))
+
+    selected = []
+    for prefix in sorted(taps):
+        tap = taps[prefix]
+        tool_shed_url = TOOLSHED_MAP[prefix]
+        metadata = None
+        shed_selected = []
+        with tap.profiler.stage("listing"):
+            if kwds["use_metadata"]:
+                try:
+                    metadata = repository_metadata(tool_shed_url, cache=tap.cache)
+                except Exception as e:
+                    click.echo("Failed to fetch repository metadata, checking every repository [%s]" % e)
+            for raw_repo in repos(tool_shed_url, owner=kwds["owner"], name_filter=kwds["name_filter"], cache=tap.cache):
+                repo = Repo.from_api(prefix, raw_repo, metadata=metadata)
+                if not repo.may_have_tool_dependencies():
+                    continue
+                shed_selected.append((repo, tap))
+        if metadata is not None:
+            click.echo("%d repositories with tool dependencies selected from %s metadata" % (len(shed_selected), prefix))
+        selected.extend(shed_selected)
+
+    if kwds["crawl"]:
+        crawl(selected, taps, threads=kwds["crawl_threads"])
+    else:
+        pending = []
+        for repo, tap in selected:
+            if tap.journal.completed(repo):
+                click.echo("skipping repository %s, already completed in journal" % repo)
+                continue
+            pending.append((repo, tap))
+        convert_repositories(pending)
+
+    for tap in taps.values():
+        tap.journal.close()
+        tap.index.save()
+    mirror = taps[kwds["tool_shed"][0]].mirror
+    if mirror:
+        mirror.close()
+    url_checker = taps[kwds["tool_shed"][0]].url_checker
+    if url_checker:
+        url_checker.close()
+        if kwds["url_report"]:
+            url_checker.write_report(kwds["url_report"])
+    write_profile(taps[kwds["tool_shed"][0]].profiler, kwds)
+
+    for tap in taps.values():
+        target = tap.target
+        shell("git init %s" % target)
+        shell("git --work-tree %s --git-dir %s/.git add %s/*" % (target, target, target))
+        shell("git --work-tree %s --git-dir %s/.git commit -m 'Initial Commit' " % (target, target))
+
+
+def setup_taps(kwds):
+    """ Build a Tap for every targeted tool shed. The taps share one mirror,
+    cache and HTTP session and know about each other so cross-shed
+    dependencies resolve to the right tap.
+    """
     user = kwds["git_user"]
-    repo_name = "homebrew-%s" % kwds["tool_shed"]
-    target = os.path.join(kwds["brew_directory"], "Library", "Taps", user, repo_name )
-
-    tap = Tap("%s/%s" % (user, kwds["tool_shed"]))
-    #shell("rm -rf %s" % target)
-    shell("mkdir -p %s" % target)
-    prefix = kwds["tool_shed"]
-    tool_shed_url = TOOLSHED_MAP[prefix]
-    dependencies_list = []
-    for raw_repo in repos(tool_shed_url, owner=kwds["owner"], name_filter=kwds["name_filter"]):
-        repo = Repo.from_api(prefix, raw_repo)
-        dependencies_file = repo.get_file("tool_dependencies.xml")
-        if not dependencies_file:
-            click.echo("skipping repository %s, no tool_dependencies.xml" % repo)
+    mirror = None
+    if kwds["mirror_directory"]:
+        mirror = Mirror(kwds["mirror_directory"], url=kwds["mirror_url"], threads=kwds["mirror_threads"])
+    cache = Cache(kwds["cache_directory"], listing_ttl=kwds["listing_ttl"])
+    url_checker = None
+    if kwds["check_urls"]:
+        url_checker = UrlChecker(
+            os.path.join(kwds["cache_directory"], "url_health.json"),
+            policy=kwds["dead_urls"],
+            threads=kwds["check_threads"],
+            host_limit=kwds["check_host_limit"],
+            ttl=kwds["check_ttl"],
+        )
+    profiler = Profiler(memory=kwds["profile_memory"], sample_every=kwds["profile_sample"])
+    taps = {}
+    for prefix in kwds["tool_shed"]:
+        repo_name = "homebrew-%s" % prefix
+        target = os.path.join(kwds["brew_directory"], "Library", "Taps", user, repo_name )
+        tap_name = "%s/%s" % (user, prefix)
+        index = FormulaIndex(os.path.join(target, FORMULA_INDEX_NAME), tap_name)
+        shard = kwds["shard"]
+        if shard is None:
+            shard = bool(index.shard)
+        index.shard = shard
+        taps[prefix] = Tap(
+            tap_name,
+            tool_shed=prefix,
+            target=target,
+            mirror=mirror,
+            cache=cache,
+            url_checker=url_checker,
+            index=index,
+            shard=shard,
+            package_filter=kwds["package"],
+            version_filter=kwds["version"],
+            profiler=profiler,
+            siblings=taps,
+        )
+        #shell("rm -rf %s" % target)
+        shell("mkdir -p %s" % target)
+    return taps
+
+
+def write_profile(profiler, kwds):
+    """ Write the run's timing statistics (and memory profile) if requested. """
+    if not (kwds["stats"] or kwds["profile_memory"]):
+        return
+    stats_path = kwds["stats"] or DEFAULT_STATS_NAME
+    write_atomic(stats_path, json.dumps(profiler.timing_report(), indent=2, sort_keys=True))
+    click.echo("wrote timing statistics to %s" % stats_path)
+    if kwds["profile_memory"]:
+        memory_path = "%s.memory.json" % os.path.splitext(stats_path)[0]
+        write_atomic(memory_path, json.dumps(profiler.memory_report(), indent=2, sort_keys=True))
+        click.echo("wrote memory profile to %s" % memory_path)
+
+
+@main.command("regen")
+@click.argument("formula")
+@click.option('--latest', is_flag=True, default=False, help='Fetch the tip of the repository instead of the indexed changeset.')
+@click.pass_context
+def regen(ctx, formula, latest):
+    """ Regenerate FORMULA (and its sibling formulas) from its repository. """
+    kwds = ctx.obj
+    taps = setup_taps(kwds)
+    name = formula.split("/")[-1]
+    if name.endswith(".rb"):
+        name = name[:-len(".rb")]
+    for tap in taps.values():
+        entry = tap.index.get(name)
+        if entry is not None:
+            break
+    else:
+        paths = ", ".join(t.index.path for t in taps.values())
+        raise click.ClickException("formula [%s] not found in %s" % (name, paths))
+
+    repo = Repo.from_api(entry["tool_shed"], {"owner": entry["owner"], "name": entry["repository"]})
+    if not latest:
+        repo.changeset_revision = entry["changeset_revision"]
+    target = tap.target
+    tap.journal = Journal(os.path.join(target, JOURNAL_NAME), resume=True)
+    dependencies = convert_repository(repo, tap)
+    tap.journal.close()
+    tap.index.save()
+    if tap.mirror:
+        tap.mirror.close()
+    if tap.url_checker:
+        tap.url_checker.close()
+        if kwds["url_report"]:
+            tap.url_checker.write_report(kwds["url_report"])
+    write_profile(tap.profiler, kwds)
+    if dependencies is None:
+        raise click.ClickException("failed to regenerate formula [%s]" % name)
+
+    recipes = tap.journal.entries[Journal.key(repo)]["recipes"]
+    if os.path.exists(os.path.join(target, ".git")):
+        paths = " ".join(os.path.join(target, r) for r in recipes + [FORMULA_INDEX_NAME])
+        shell("git --work-tree %s --git-dir %s/.git add %s" % (target, target, paths))
+        shell("git --work-tree %s --git-dir %s/.git commit -m 'Regenerate %s' " % (target, target, name))
+
+
+def convert_repository(repo, tap):
+    dependencies = parse_repository((repo, tap))
+    if dependencies is None:
+        return None
+    prepare_downloads([(repo, tap, dependencies)])
+    render_repository(repo, tap, dependencies)
+    return dependencies
+
+
+def convert_repositories(repos, pool=None):
+    """ Convert (repo, tap) pairs, returning the (repo, tap) pairs referenced
+    by the converted repositories.
+
+    Repositories are handled in batches of CONVERT_BATCH_SIZE: each batch is
+    fetched and parsed (on ``pool`` if given), the download URLs of the whole
+    batch are mirrored and checked concurrently and then its formulas - which
+    need the mirrored checksums - are rendered and journaled before the next
+    batch is fetched.
+    """
+    map_ = pool.map if pool else map
+    references = []
+    for start in range(0, len(repos), CONVERT_BATCH_SIZE):
+        batch = repos[start:start + CONVERT_BATCH_SIZE]
+        parsed = []
+        for (repo, tap), dependencies in zip(batch, map_(parse_repository, batch)):
+            if dependencies is not None:
+                parsed.append((repo, tap, dependencies))
+        prepare_downloads(parsed)
+        for repo, tap, dependencies in parsed:
+            render_repository(repo, tap, dependencies)
+            references.extend((r, tap) for r in dependencies.referenced_repos())
+    return references
+
+
+def prepare_downloads(parsed):
+    mirrors = {}
+    url_checkers = {}
+    for repo, tap, dependencies in parsed:
+        if tap.mirror:
+            mirrors.setdefault(tap.mirror, (tap, []))[1].extend(dependencies.download_urls())
+        if tap.url_checker:
+            url_checkers.setdefault(tap.url_checker, (tap, []))[1].extend(dependencies.download_urls())
+    for mirror, (tap, urls) in mirrors.items():
+        with tap.profiler.stage("mirror"):
+            mirror.mirror(urls)
+    for url_checker, (tap, urls) in url_checkers.items():
+        with tap.profiler.stage("check"):
+            url_checker.check(urls)
+    for repo, tap, dependencies in parsed:
+        if tap.mirror:
+            mirrored = [url for url in dependencies.download_urls() if tap.mirror.lookup(url)]
+            tap.journal.record(repo, "mirror", "ok", urls=len(mirrored))
+
+
+def parse_repository(repo_and_tap):
+    repo, tap = repo_and_tap
+    journal = tap.journal
+    stage = tap.profiler.stage
+    try:
+        with stage("fetch"):
+            dependencies_file = repo.get_file("tool_dependencies.xml", cache=tap.cache)
+    except Exception as e:
+        # Not terminal in the journal, so --resume retries the repository.
+        click.echo("Failed to fetch tool_dependencies.xml for repo %s [%s]" % (repo, e))
+        journal.record(repo, "fetch", "failed", error=str(e))
+        return None
+    if not dependencies_file:
+        click.echo("skipping repository %s, no tool_dependencies.xml" % repo)
+        journal.record(repo, "fetch", "skipped")
+        return None
+    journal.record(repo, "fetch", "ok")
+
+    try:
+        with stage("parse"):
+            dependencies = Dependencies(dependencies_file, repo, tap, package=tap.package_filter, version=tap.version_filter)
+    except Exception as e:
+        print "Failed to parse dependencies for repo %s, skipping." % repo
+        journal.record(repo, "parse", "failed", error=str(e))
+        return None
+    journal.record(repo, "parse", "ok")
+    return dependencies
+
+
+def render_repository(repo, tap, dependencies):
+    target = tap.target
+    journal = tap.journal
+    stage = tap.profiler.stage
+    recipes = []
+    formulas = {}
+    failed = []
+    skipped = []
+    for package in dependencies.packages:
+        if tap.url_checker:
+            # Registered before skipping so the report lists the dead URLs too.
+            name = package.get_recipe_name().replace("__", "_")
+            tap.url_checker.add_formula(package.download_urls(), name)
+            dead = tap.url_checker.dead_urls(package.download_urls())
+            if dead and tap.url_checker.policy == "skip":
+                click.echo("skipping package [%s], dead download urls %s" % (package.package_el.attrib.get("name"), dead))
+                skipped.append(package.package_el.attrib.get("name"))
+                # Don't leave a formula from an earlier run behind.
+                for shard in [True, False]:
+                    stale_path = os.path.join(target, tap.recipe_path("%s.rb" % name, shard=shard))
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+                if tap.index is not None:
+                    tap.index.remove(name)
+                continue
+        try:
+            with stage("render"):
+                (file_name, contents) = package.to_recipe()
+            path = tap.recipe_path(file_name)
+            with stage("write"):
+                recipe_path = os.path.join(target, path)
+                ensure_directory(os.path.dirname(recipe_path))
+                open(recipe_path, "w").write(contents)
+                # Drop the copy left behind by a run with the other layout.
+                other_path = os.path.join(target, tap.recipe_path(file_name, shard=not tap.shard))
+                if os.path.exists(other_path):
+                    os.remove(other_path)
+            recipes.append(path)
+            entry = package.index_entry()
+            entry["path"] = path
+            entry["sha256"] = hashlib.sha256(contents).hexdigest()
+            formulas[file_name[:-len(".rb")]] = entry
+        except Exception as e:
+            traceback.print_exc()
+            print "Failed to convert package [%s], exception [%s]" % (package, e)
+            failed.append(package.package_el.attrib.get("name"))
+    if tap.index is not None:
+        tap.index.update(formulas)
+    references = [Journal.key(r) for r in dependencies.referenced_repos()]
+    journal.record(repo, "render", "ok", recipes=recipes, formulas=formulas, failed=failed, skipped=skipped, references=references)
+
+
+Recipe = collections.namedtuple("Recipe", ["formula", "file_name", "contents", "package", "version", "repository", "error"])
+
+
+def convert(sources, git_user=GIT_USER, package=None, version=None):
+    """ Convert tool_dependencies.xml documents to Homebrew recipes in-process.
+
+    ``sources`` is an iterable of ``(contents, repository)`` pairs, where
+    ``contents`` is the tool_dependencies.xml document (bytes) and
+    ``repository`` is a dict with the ``owner`` and ``name`` of the tool shed
+    repository it came from and optionally ``tool_shed`` (a key of
+    TOOLSHED_MAP, defaults to ``"toolshed"``) and ``changeset_revision``.
+
+    Returns an iterator yielding a ``Recipe`` for every package with install
+    actions, lazily consuming ``sources``. A document or package that cannot
+    be converted yields a ``Recipe`` with ``contents`` of None and the
+    failure in ``error`` rather than raising, so one bad input does not end
+    a batch. ``package`` and ``version`` restrict conversion to packages with
+    that name and/or version.
+
+    Nothing is written, fetched or committed, and no state is shared between
+    calls, so this is safe to call from many threads at once.
+    """
+    taps = {}
+    for contents, repository in sources:
+        try:
+            prefix = repository.get("tool_shed", "toolshed")
+            if prefix not in TOOLSHED_MAP:
+                raise ValueError("unknown tool shed %s" % prefix)
+            repo = Repo.from_api(prefix, repository)
+            repo.changeset_revision = repository.get("changeset_revision")
+        except Exception as e:
+            yield Recipe(None, None, None, None, None, repository, "Invalid repository [%s: %s]" % (e.__class__.__name__, e))
             continue
+        if prefix not in taps:
+            taps[prefix] = Tap("%s/%s" % (git_user, prefix), tool_shed=prefix)
         try:
-            dependencies = Dependencies(dependencies_file, repo, tap)
+            dependencies = Dependencies(io.BytesIO(contents), repo, taps[prefix], package=package, version=version)
         except Exception as e:
-            print "Failed to parse dependencies for repo %s, skipping." % repo
+            yield Recipe(None, None, None, None, None, repository, "Failed to parse dependencies [%s]" % e)
             continue
-        dependencies_list.append(dependencies)
-
-    for dependencies in dependencies_list:
+        # Not package/version, those are the filters for every source.
+        for dependency_package in dependencies.packages:
+            package_name = dependency_package.package_el.attrib["name"]
+            package_version = dependency_package.package_el.attrib["version"]
+            try:
+                file_name, recipe = dependency_package.to_recipe()
+            except Exception as e:
+                yield Recipe(None, None, None, package_name, package_version, repository, "Failed to convert package [%s]" % e)
+                continue
+            yield Recipe(file_name[:-len(".rb")], file_name, recipe, package_name, package_version, repository, None)
+
+
+def crawl(repos, taps, threads=8):
+    """ Convert (repo, tap) pairs and, breadth-first, every repository they
+    reference (on any tool shed) until the set of generated repositories is
+    closed. References land in the tap of their own tool shed when it is
+    being generated too, otherwise in the tap of the referencing repository.
+    """
+    pool = ThreadPool(threads)
+
+    def crawl_level(level):
+        references = []
+        pending = []
+        for repo, tap in level:
+            if tap.journal.completed(repo):
+                click.echo("skipping repository %s, already completed in journal" % repo)
+                references.extend((r, tap) for r in tap.journal.references(repo))
+            else:
+                pending.append((repo, tap))
+        references.extend(convert_repositories(pending, pool=pool))
+        return [(r, taps.get(r.prefix, tap)) for r, tap in references]
+
+    # Registry of every repository handled in this run, across tool sheds.
+    seen = set(Journal.key(r) for r, tap in repos)
+    level = repos
+    try:
+        while level:
+            next_level = []
+            for reference, tap in crawl_level(level):
+                key = Journal.key(reference)
+                if key not in seen:
+                    seen.add(key)
+                    next_level.append((reference, tap))
+            if next_level:
+                click.echo("crawling %d referenced repositories" % len(next_level))
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
+
+
+@main.group("cache")
+def cache_command():
+    """ Export or import the fetch cache. """
+
+
+@cache_command.command("export")
+@click.argument("archive")
+@click.option('--cache_directory', default=DEFAULT_CACHE_DIRECTORY)
+@click.option('--mirror_directory', default=None, help='Include the checksum index of this mirror.')
+def cache_export(archive, cache_directory, mirror_directory):
+    """ Pack the cache into a compressed, versioned ARCHIVE. """
+    cache = Cache(cache_directory)
+    count = cache.export_archive(archive, mirror_directory=mirror_directory)
+    click.echo("exported %d cache entries to %s" % (count, archive))
+
+
+@cache_command.command("import")
+@click.argument("archive")
+@click.option('--cache_directory', default=DEFAULT_CACHE_DIRECTORY)
+@click.option('--mirror_directory', default=None, help='Merge the archived checksum index into this mirror.')
+def cache_import(archive, cache_directory, mirror_directory):
+    """ Verify ARCHIVE and merge its newer entries into the cache. """
+    cache = Cache(cache_directory)
+    count = cache.import_archive(archive, mirror_directory=mirror_directory)
+    click.echo("imported %d cache entries from %s" % (count, archive))
+
+
+@main.command("golden")
+@click.option('--corpus', default=GOLDEN_DIRECTORY, help='Directory of <tool_shed>/<owner>/<name>/tool_dependencies.xml cases.')
+@click.option('--jobs', default=multiprocessing.cpu_count(), type=int, help='Number of render processes.')
+@click.option('--repeat', default=1, type=int, help='Render every case this many times and report the fastest.')
+@click.option('--update', is_flag=True, default=False, help='Rewrite expected recipes from the current output.')
+@click.option('--report', default=None, help='Write a JSON report of every rendered file to this path.')
+def golden(corpus, jobs, repeat, update, report):
+    """ Render the golden corpus and diff it against the expected recipes. """
+    cases = golden_cases(corpus)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(render_golden_case, [(corpus, case, repeat, update) for case in cases])
+    finally:
+        pool.close()
+        pool.join()
+
+    files = []
+    for result in results:
+        files.extend(result["files"])
+    for f in sorted(files, key=lambda f: -f["render_seconds"]):
+        click.echo("%9.3fms  %-8s %s" % (f["render_seconds"] * 1000, f["status"], f["file"]))
+    for f in files:
+        if f["diff"]:
+            click.echo("\n".join(f["diff"]))
+
+    counts = {}
+    for f in files:
+        counts[f["status"]] = counts.get(f["status"], 0) + 1
+    total = sum(f["render_seconds"] for f in files)
+    parse_total = sum(r["parse_seconds"] for r in results)
+    click.echo("%d cases, %d files (%s), parse %.3fms, render %.3fms" % (
+        len(results),
+        len(files),
+        ", ".join("%d %s" % (c, s) for s, c in sorted(counts.items())),
+        parse_total * 1000,
+        total * 1000,
+    ))
+    problems = []
+    if not update:
+        problems = check_golden_convert(corpus, cases)
+        for problem in problems:
+            click.echo(problem)
+        click.echo("convert: %d cases in one call, %s" % (len(cases), "%d problems" % len(problems) if problems else "same"))
+    if report:
+        with open(report, "w") as f:
+            json.dump({"cases": results, "counts": counts, "parse_seconds": parse_total, "render_seconds": total, "convert_problems": problems}, f, indent=1)
+    if not update and (set(counts) - set(["same"]) or problems):
+        sys.exit(1)
+
+
+def golden_cases(corpus):
+    cases = []
+    for dirpath, dirnames, filenames in os.walk(corpus):
+        if "tool_dependencies.xml" in filenames:
+            cases.append(os.path.relpath(dirpath, corpus))
+    return sorted(cases)
+
+
+def check_golden_convert(corpus, cases):
+    """ Convert every case in a single ``convert`` call and describe each
+    recipe that differs from the expected ones - catching state leaking from
+    one document into the next.
+    """
+    sources = []
+    expected = {}
+    for case in cases:
+        prefix, owner, name = case.split(os.sep)
+        with open(os.path.join(corpus, case, "tool_dependencies.xml"), "rb") as f:
+            sources.append((f.read(), {"owner": owner, "name": name, "tool_shed": prefix}))
+        expected_directory = os.path.join(corpus, case, "expected")
+        if os.path.isdir(expected_directory):
+            for file_name in os.listdir(expected_directory):
+                if file_name.endswith(".rb"):
+                    expected[os.path.join(case, file_name)] = os.path.join(expected_directory, file_name)
+
+    problems = []
+    converted = set()
+    for recipe in convert(sources):
+        repository = recipe.repository
+        case = os.path.join(repository["tool_shed"], repository["owner"], repository["name"])
+        if recipe.error:
+            problems.append("convert failed for %s: %s" % (case, recipe.error))
+            continue
+        path = os.path.join(case, recipe.file_name)
+        converted.add(path)
+        if path not in expected:
+            problems.append("convert produced unexpected %s" % path)
+            continue
+        with open(expected[path], "r") as f:
+            if f.read() != recipe.contents:
+                problems.append("convert output differs for %s" % path)
+    for path in sorted(set(expected) - converted):
+        problems.append("convert did not produce %s" % path)
+    return problems
+
+
+def render_golden_case(args):
+    """ Render one golden corpus case (a <tool_shed>/<owner>/<name>
+    directory) and compare each recipe with ``expected/<file>.rb``.
+    """
+    corpus, case, repeat, update = args
+    prefix, owner, name = case.split(os.sep)
+    case_directory = os.path.join(corpus, case)
+    expected_directory = os.path.join(case_directory, "expected")
+    repo = Repo.from_api(prefix, {"owner": owner, "name": name})
+    tap = Tap("%s/%s" % (GIT_USER, prefix))
+    dependencies_file = os.path.join(case_directory, "tool_dependencies.xml")
+
+    parse_seconds = None
+    rendered = {}
+    errors = {}
+    render_seconds = {}
+    for i in range(repeat):
+        start = time.time()
+        dependencies = Dependencies(dependencies_file, repo, tap)
+        elapsed = time.time() - start
+        parse_seconds = elapsed if parse_seconds is None else min(parse_seconds, elapsed)
         for package in dependencies.packages:
+            start = time.time()
             try:
-                (file_name, contents) = package.to_recipe()
-                recipe_path = os.path.join(target, file_name)
-                open(recipe_path, "w").write(contents)
+                file_name, contents = package.to_recipe()
+                rendered[file_name] = contents
             except Exception as e:
-                traceback.print_exc()
-                print "Failed to convert package [%s], exception [%s]" % (package, e)
+                file_name = "%s.rb" % package.get_recipe_name()
+                errors[file_name] = "%s: %s" % (e.__class__.__name__, e)
+            elapsed = time.time() - start
+            render_seconds[file_name] = min(render_seconds.get(file_name, elapsed), elapsed)
+
+    expected = set()
+    if os.path.isdir(expected_directory):
+        expected = set(f for f in os.listdir(expected_directory) if f.endswith(".rb"))
+    if update:
+        if not os.path.exists(expected_directory):
+            os.makedirs(expected_directory)
+        for file_name in expected - set(rendered):
+            os.remove(os.path.join(expected_directory, file_name))
+
+    files = []
+    for file_name in sorted(expected | set(rendered) | set(errors)):
+        expected_path = os.path.join(expected_directory, file_name)
+        path = os.path.join(case, file_name)
+        contents = rendered.get(file_name)
+        diff = []
+        if file_name in errors:
+            status = "error"
+            diff = [errors[file_name]]
+        elif file_name not in rendered:
+            status = "missing"
+        elif file_name not in expected:
+            status = "new"
+        else:
+            with open(expected_path, "r") as f:
+                expected_contents = f.read()
+            if expected_contents == contents:
+                status = "same"
+            else:
+                status = "changed"
+                diff = list(difflib.unified_diff(
+                    expected_contents.splitlines(),
+                    contents.splitlines(),
+                    os.path.join(case, "expected", file_name),
+                    path,
+                    lineterm="",
+                ))
+        if update and contents is not None:
+            with open(expected_path, "w") as f:
+                f.write(contents)
+        files.append({
+            "file": path,
+            "status": status,
+            "diff": diff,
+            "render_seconds": render_seconds.get(file_name, 0.0),
+        })
+    return {"case": case, "parse_seconds": parse_seconds, "files": files}
+
+
+class Journal(object):
+    """ Append-only JSON-lines record of per-repository progress. """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Trailing line of a run killed mid-write.
+                        continue
+                    self.entries[entry["repository"]] = entry
+        self._file = open(path, "a" if resume else "w")
+        self._lock = threading.Lock()
+
+    def completed(self, repo):
+        entry = self.entries.get(self.key(repo))
+        if entry is None:
+            return False
+        return (entry["stage"], entry["status"]) in JOURNAL_TERMINAL
+
+    def references(self, repo):
+        entry = self.entries.get(self.key(repo), {})
+        references = []
+        for key in entry.get("references", []):
+            prefix, owner, name = key.split("/", 2)
+            references.append(Repo.from_api(prefix, {"owner": owner, "name": name}))
+        return references
+
+    def record(self, repo, stage, status, **kwds):
+        entry = dict(kwds)
+        entry["repository"] = self.key(repo)
+        entry["stage"] = stage
+        entry["status"] = status
+        entry["time"] = time.time()
+        with self._lock:
+            self.entries[entry["repository"]] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
 
-    shell("git init %s" % target)
-    shell("git --work-tree %s --git-dir %s/.git add %s/*" % (target, target, target))
-    shell("git --work-tree %s --git-dir %s/.git commit -m 'Initial Commit' " % (target, target))
+    @staticmethod
+    def key(repo):
+        return "%s/%s/%s" % (repo.prefix, repo.owner, repo.name)
 
 
 class Tap(object):
 
-    def __init__(self, prefix):
+    def __init__(self, prefix, tool_shed=None, target=None, mirror=None, cache=None, url_checker=None, index=None, shard=False, package_filter=None, version_filter=None, profiler=None, siblings=None):
         self.prefix = prefix
+        self.tool_shed = tool_shed
+        self.target = target
+        self.mirror = mirror
+        self.cache = cache
+        self.url_checker = url_checker
+        self.index = index
+        self.shard = shard
+        self.package_filter = package_filter
+        self.version_filter = version_filter
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.siblings = siblings if siblings is not None else {}
+        self.journal = None
+
+    def tap_for(self, repo):
+        """ Tap generating repo's formulas in this run (defaults to self). """
+        return self.siblings.get(repo.prefix, self)
+
+    def recipe_path(self, file_name, shard=None):
+        if shard is None:
+            shard = self.shard
+        if shard:
+            return os.path.join("Formula", file_name[0].lower(), file_name)
+        return file_name
+
+
+class Profiler(object):
+    """ Accumulates wall time per run stage (listing, fetch, parse, ...).
+
+    With ``memory`` set it also tracks resident set size per stage and which
+    object types each stage leaves behind, by counting the objects the
+    garbage collector tracks (elements, dicts, lists, class instances - not
+    strings) by type before and after the stage. Walking every object is
+    expensive, so that is only done around every ``sample_every``-th call of
+    a stage (always the first). Stages overlap while crawling with several
+    threads, memory is only attributed exactly to a stage in sequential runs.
+    """
+
+    def __init__(self, memory=False, sample_every=100, top=10):
+        self.memory = memory
+        self.sample_every = max(sample_every, 1)
+        self.top = top
+        self.stages = collections.OrderedDict()
+        self.types = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = {"calls": 0, "seconds": 0.0}
+                self.types[name] = {}
+            call = stats["calls"]
+            stats["calls"] += 1
+        before = None
+        if self.memory:
+            before = self._measure(objects=call % self.sample_every == 0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            after = None
+            if self.memory:
+                after = self._measure(objects="objects" in before, before=before)
+            with self.lock:
+                stats["seconds"] += elapsed
+                if after is not None:
+                    self._record(name, stats, before, after)
+
+    def _measure(self, objects=False, before=None):
+        census = None
+        if objects:
+            ignore = [before, before["objects"]] if before else []
+            census = object_census(ignore=ignore)
+        measure = {"rss": current_rss(), "peak_rss": peak_rss()}
+        if census is not None:
+            measure["objects"] = census
+        return measure
+
+    def _record(self, name, stats, before, after):
+        if after["rss"] is not None and before["rss"] is not None:
+            stats["rss_delta_bytes"] = stats.get("rss_delta_bytes", 0) + after["rss"] - before["rss"]
+            stats["max_rss_bytes"] = max(stats.get("max_rss_bytes", 0), after["rss"])
+        if after["peak_rss"] is not None and before["peak_rss"] is not None:
+            # How far this stage pushed the process high-water mark.
+            stats["peak_rss_raised_bytes"] = stats.get("peak_rss_raised_bytes", 0) + after["peak_rss"] - before["peak_rss"]
+        if "objects" not in after:
+            return
+        stats["sampled_calls"] = stats.get("sampled_calls", 0) + 1
+        types = self.types[name]
+        before_counts, before_sizes = before["objects"]
+        after_counts, after_sizes = after["objects"]
+        for type_name in set(before_counts) | set(after_counts):
+            count = after_counts.get(type_name, 0) - before_counts.get(type_name, 0)
+            size = after_sizes.get(type_name, 0) - before_sizes.get(type_name, 0)
+            if count or size:
+                totals = types.setdefault(type_name, [0, 0])
+                totals[0] += count
+                totals[1] += size
+
+    def timing_report(self):
+        with self.lock:
+            stages = dict((name, {"calls": stats["calls"], "seconds": stats["seconds"]}) for name, stats in self.stages.items())
+        return {"stages": stages}
+
+    def memory_report(self):
+        stages = {}
+        with self.lock:
+            for name, stats in self.stages.items():
+                stage = dict(stats)
+                types = sorted(self.types[name].items(), key=lambda item: -item[1][1])[:self.top]
+                stage["top_types"] = [{"type": type_name, "count": count, "size_bytes": size} for type_name, (count, size) in types if size > 0]
+                stages[name] = stage
+        return {"process_peak_rss_bytes": peak_rss(), "stages": stages}
+
+
+def object_census(ignore=()):
+    """ Counts and shallow sizes in bytes of gc-tracked objects by type,
+    leaving out the objects in ``ignore``.
+    """
+    # Flat str -> int dicts aren't tracked themselves, so they don't skew
+    # the census they are compared with.
+    counts = {}
+    sizes = {}
+    ignore_ids = set(id(obj) for obj in ignore)
+    objects = gc.get_objects()
+    for obj in objects:
+        if id(obj) in ignore_ids:
+            continue
+        cls = type(obj)
+        key = "%s.%s" % (cls.__module__, cls.__name__)
+        counts[key] = counts.get(key, 0) + 1
+        sizes[key] = sizes.get(key, 0) + sys.getsizeof(obj, 0)
+    del objects
+    return counts, sizes
+
+
+class UrlChecker(object):
+    """ Checks that download URLs are alive without fetching them.
+
+    A HEAD request is tried first, falling back to a GET of the first byte
+    for servers that refuse HEAD. Results are cached in ``path`` for ``ttl``
+    seconds and at most ``host_limit`` checks run against one host at once.
+    """
+
+    def __init__(self, path, policy="annotate", threads=16, host_limit=4, ttl=86400):
+        self.path = path
+        self.policy = policy
+        self.host_limit = host_limit
+        self.ttl = ttl
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.results = json.load(f)
+        self.formulas = {}
+        self._lock = threading.Lock()
+        self._host_semaphores = {}
+        self._pool = ThreadPool(threads)
+
+    def check(self, urls):
+        now = time.time()
+        pending = []
+        seen = set()
+        for url in urls:
+            result = self.results.get(url)
+            if result is not None and now - result["time"] < self.ttl:
+                continue
+            if url not in seen:
+                seen.add(url)
+                pending.append(url)
+        for url, result in self._pool.imap_unordered(self._check, pending):
+            with self._lock:
+                self.results[url] = result
+
+    def dead_urls(self, urls):
+        return [u for u in urls if self.results.get(u, {}).get("alive") is False]
+
+    def describe(self, url):
+        result = self.results[url]
+        return result["error"] or "HTTP %s" % result["status"]
+
+    def add_formula(self, urls, formula):
+        with self._lock:
+            for url in urls:
+                self.formulas.setdefault(url, set()).add(formula)
+
+    def write_report(self, path):
+        urls = {}
+        for url, formulas in self.formulas.items():
+            result = dict(self.results.get(url, {}))
+            result["formulas"] = sorted(formulas)
+            urls[url] = result
+        report = {
+            "checked": len(urls),
+            "dead": sorted(u for u, r in urls.items() if r.get("alive") is False),
+            "unknown": sorted(u for u, r in urls.items() if r.get("alive") is None),
+            "urls": urls,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            contents = json.dumps(self.results, indent=1, sort_keys=True)
+        write_atomic(self.path, contents)
+
+    def _check(self, url):
+        result = {"alive": None, "status": None, "error": None, "time": time.time()}
+        parsed = urlparse.urlparse(url.strip())
+        if parsed.scheme not in ["http", "https"]:
+            result["error"] = "cannot check %s URLs" % (parsed.scheme or "relative")
+            return url, result
+        with self._lock:
+            semaphore = self._host_semaphores.get(parsed.netloc)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.host_limit)
+                self._host_semaphores[parsed.netloc] = semaphore
+        with semaphore:
+            try:
+                session = http_session()
+                response = session.head(url.strip(), allow_redirects=True, timeout=30)
+                if response.status_code in [403, 405, 501]:
+                    # Some servers refuse HEAD - ask for the first byte instead.
+                    response = session.get(url.strip(), headers={"Range": "bytes=0-0"}, stream=True, timeout=30)
+                    response.close()
+                result["status"] = response.status_code
+                result["alive"] = response.status_code < 400
+            except requests.exceptions.Timeout as e:
+                # Slow is not dead - leave it unknown and retry next run.
+                result["error"] = str(e)
+                result["time"] = 0
+            except Exception as e:
+                result["alive"] = False
+                result["error"] = str(e)
+        return url, result
+
+
+class FormulaIndex(object):
+    """ Machine-readable manifest of the tap.
+
+    Maps each generated formula name to the tool shed repository and package
+    it was generated from, its path within the tap, its dependencies and the
+    sha256 of its contents - so formulas can be found, validated and
+    regenerated on their own without opening every recipe.
+    """
+
+    def __init__(self, path, tap=None):
+        self.path = path
+        self.tap = tap
+        self.formulas = {}
+        # Whether the tap uses the Formula/<first letter>/ layout, None if unknown.
+        self.shard = None
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                index = json.load(f)
+            self.formulas = index["formulas"]
+            self.shard = index.get("shard")
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        return self.formulas.get(name)
+
+    def update(self, formulas):
+        with self._lock:
+            self.formulas.update(formulas)
+
+    def remove(self, name):
+        with self._lock:
+            self.formulas.pop(name, None)
+
+    def save(self):
+        with self._lock:
+            index = {
+                "version": FORMULA_INDEX_VERSION,
+                "tap": self.tap,
+                "shard": bool(self.shard),
+                "formulas": self.formulas,
+            }
+            contents = json.dumps(index, indent=1, sort_keys=True)
+        write_atomic(self.path, contents)
+
+
+class Cache(object):
+    """ On-disk cache of tool shed responses.
+
+    ``files/`` holds successfully fetched repository files keyed by
+    changeset revision (so entries never go stale) and ``listings/`` holds repository listings and
+    metadata, which are refetched once older than ``listing_ttl`` seconds.
+    """
+
+    def __init__(self, directory, listing_ttl=3600):
+        self.directory = directory
+        self.listing_ttl = listing_ttl
+
+    def file_path(self, repo, path):
+        return os.path.join(self.directory, "files", repo.prefix, repo.owner, repo.name, repo.changeset_revision, path)
+
+    def get_file(self, repo, path):
+        if not getattr(repo, "changeset_revision", None):
+            return None
+        cached_path = self.file_path(repo, path)
+        if os.path.exists(cached_path):
+            return cached_path
+        return None
+
+    def put_file(self, repo, path, contents):
+        """ Cache contents, returning the cached path (None if uncacheable). """
+        if not getattr(repo, "changeset_revision", None):
+            return None
+        cached_path = self.file_path(repo, path)
+        ensure_directory(os.path.dirname(cached_path))
+        write_atomic(cached_path, contents)
+        return cached_path
+
+    def listing(self, name, fetch):
+        path = os.path.join(self.directory, "listings", "%s.json" % name)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                cached = json.load(f)
+            if time.time() - cached["time"] < self.listing_ttl:
+                return cached["data"]
+        data = fetch()
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        write_atomic(path, json.dumps({"time": time.time(), "data": data}))
+        return data
+
+    def export_archive(self, archive, mirror_directory=None):
+        members = []
+        for subdirectory in ["files", "listings"]:
+            root = os.path.join(self.directory, subdirectory)
+            for dirpath, dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    members.append((os.path.relpath(path, self.directory), path))
+        if mirror_directory:
+            mirror_index = os.path.join(mirror_directory, "index.json")
+            if os.path.exists(mirror_index):
+                members.append(("checksums/index.json", mirror_index))
+
+        entries = []
+        for name, path in members:
+            entries.append({
+                "path": name,
+                "sha256": file_sha256(path),
+                "size": os.path.getsize(path),
+                "mtime": os.path.getmtime(path),
+            })
+        manifest = {
+            "format": CACHE_ARCHIVE_FORMAT,
+            "version": CACHE_ARCHIVE_VERSION,
+            "created": time.time(),
+            "entries": entries,
+        }
+        fd, manifest_path = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f)
+        try:
+            with tarfile.open(archive, "w:gz") as tar:
+                tar.add(manifest_path, arcname="manifest.json")
+                for name, path in members:
+                    tar.add(path, arcname=name)
+        finally:
+            os.remove(manifest_path)
+        return len(entries)
+
+    def import_archive(self, archive, mirror_directory=None):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        staging = tempfile.mkdtemp(dir=self.directory, prefix=".import")
+        try:
+            manifest = None
+            with tarfile.open(archive, "r|gz") as tar:
+                # Verify everything before touching the existing cache.
+                for member in tar:
+                    if manifest is None:
+                        manifest = self._check_manifest(archive, member, tar)
+                        entries = dict((e["path"], e) for e in manifest["entries"])
+                        continue
+                    if member.isdir():
+                        continue
+                    entry = entries.get(member.name)
+                    if entry is None or not member.isfile():
+                        raise click.ClickException("unexpected member [%s] in cache archive" % member.name)
+                    staged_path = os.path.join(staging, member.name)
+                    staged_directory = os.path.dirname(staged_path)
+                    if not os.path.exists(staged_directory):
+                        os.makedirs(staged_directory)
+                    with open(staged_path, "wb") as f:
+                        shutil.copyfileobj(tar.extractfile(member), f)
+                    if os.path.getsize(staged_path) != entry["size"] or file_sha256(staged_path) != entry["sha256"]:
+                        raise click.ClickException("checksum mismatch for [%s] in cache archive" % member.name)
+            if manifest is None:
+                raise click.ClickException("%s is empty" % archive)
+            for entry in manifest["entries"]:
+                if not os.path.exists(os.path.join(staging, entry["path"])):
+                    raise click.ClickException("cache archive is missing [%s]" % entry["path"])
+
+            imported = 0
+            for entry in manifest["entries"]:
+                name = entry["path"]
+                staged_path = os.path.join(staging, name)
+                if name == "checksums/index.json":
+                    if mirror_directory:
+                        imported += merge_mirror_index(staged_path, mirror_directory)
+                    else:
+                        click.echo("no --mirror_directory given, skipping archived checksum index")
+                    continue
+                path = os.path.join(self.directory, name)
+                if os.path.exists(path):
+                    if file_sha256(path) == entry["sha256"] or os.path.getmtime(path) >= entry["mtime"]:
+                        continue
+                directory = os.path.dirname(path)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                os.rename(staged_path, path)
+                os.utime(path, (entry["mtime"], entry["mtime"]))
+                imported += 1
+            return imported
+        finally:
+            shutil.rmtree(staging)
+
+    def _check_manifest(self, archive, member, tar):
+        if member.name != "manifest.json":
+            raise click.ClickException("%s is not a shed2tap cache archive" % archive)
+        manifest = json.load(tar.extractfile(member))
+        if manifest.get("format") != CACHE_ARCHIVE_FORMAT:
+            raise click.ClickException("%s is not a shed2tap cache archive" % archive)
+        if manifest.get("version", 0) > CACHE_ARCHIVE_VERSION:
+            raise click.ClickException("cache archive version %s is newer than supported version %s" % (manifest["version"], CACHE_ARCHIVE_VERSION))
+        for entry in manifest["entries"]:
+            name = entry["path"]
+            if os.path.isabs(name) or ".." in name.split("/"):
+                raise click.ClickException("refusing unsafe path [%s] in cache archive" % name)
+        return manifest
+
+
+def merge_mirror_index(index_path, mirror_directory):
+    with open(index_path, "r") as f:
+        imported = json.load(f)
+    mirror_index = os.path.join(mirror_directory, "index.json")
+    index = {}
+    if os.path.exists(mirror_index):
+        with open(mirror_index, "r") as f:
+            index = json.load(f)
+    elif not os.path.exists(mirror_directory):
+        os.makedirs(mirror_directory)
+    added = 0
+    for url, entry in imported.items():
+        if url not in index:
+            index[url] = entry
+            added += 1
+    write_atomic(mirror_index, json.dumps(index, indent=1, sort_keys=True))
+    return added
+
+
+class Mirror(object):
+    """ Content-addressed local store of source downloads.
+
+    Files live at ``<sha256[:2]>/<sha256>/<file name>`` below ``directory``
+    and ``index.json`` maps each upstream URL to its stored path and checksums,
+    so every distinct URL is only downloaded once across packages and runs.
+    """
+
+    def __init__(self, directory, url=None, threads=8):
+        self.directory = directory
+        self.url = url
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(threads)
+
+    def mirror(self, urls):
+        pending = []
+        seen = set()
+        for url in urls:
+            if url not in self.index and url not in seen:
+                seen.add(url)
+                pending.append(url)
+        if not pending:
+            return 0
+        mirrored = 0
+        for url, entry in self._pool.imap_unordered(self._download, pending):
+            if entry is not None:
+                with self._lock:
+                    self.index[url] = entry
+                mirrored += 1
+                # Checkpoint long batches without rewriting the index per file.
+                if mirrored % MIRROR_SAVE_INTERVAL == 0:
+                    self.save()
+        self.save()
+        return mirrored
+
+    def lookup(self, url):
+        return self.index.get(url)
+
+    def rewrite(self, url):
+        entry = self.lookup(url)
+        if not self.url or entry is None:
+            return url
+        return "%s/%s" % (self.url.rstrip("/"), entry["path"])
+
+    def save(self):
+        with self._lock:
+            contents = json.dumps(self.index, indent=1, sort_keys=True)
+        write_atomic(self.index_path, contents)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.save()
+
+    def _download(self, url):
+        name = os.path.basename(urlparse.urlparse(url.strip()).path) or "download"
+        sha1 = hashlib.sha1()
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".download")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                response = http_session().get(url.strip(), stream=True, timeout=60)
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=1024 * 64):
+                    f.write(chunk)
+                    sha1.update(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            blob_directory = os.path.join(self.directory, digest[:2], digest)
+            path = os.path.join(blob_directory, name)
+            with self._lock:
+                if not os.path.exists(blob_directory):
+                    os.makedirs(blob_directory)
+                existing = os.listdir(blob_directory)
+                if name in existing:
+                    os.remove(temp_path)
+                elif existing:
+                    # Same content already stored under another name.
+                    os.remove(temp_path)
+                    os.link(os.path.join(blob_directory, existing[0]), path)
+                else:
+                    os.rename(temp_path, path)
+        except Exception as e:
+            click.echo("Failed to mirror download [%s], exception [%s]" % (url, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return url, None
+        return url, {
+            "path": os.path.relpath(path, self.directory),
+            "sha1": sha1.hexdigest(),
+            "sha256": digest,
+            "size": size,
+        }
 
 
 class Dependencies(object):
 
-    def __init__(self, dependencies_file, repo, tap):
+    def __init__(self, dependencies_file, repo, tap, package=None, version=None):
         self.repo = repo
         self.tap = tap
         self.root = ET.parse(dependencies_file).getroot()
         packages = []
         dependencies = []
+        # Packages with install actions, counted before the package/version
+        # filters so recipe names don't depend on them.
+        install_count = 0
         package_els = self.root.findall("package")
         if not package_els:
             print "No packages found for repo %s" % repo
         for package_el in package_els:
             install_els = package_el.findall("install")
-            readme_els = package_el.findall("readme")
-            if len(readme_els) > 0:
-                readme = readme_els[0].text
-            else:
-                readme = None
             assert len(install_els) in (0, 1)
             if len(install_els) == 1:
+                install_count += 1
+                if package is not None and package_el.attrib.get("name") != package:
+                    continue
+                if version is not None and package_el.attrib.get("version") != version:
+                    continue
+                readme_els = package_el.findall("readme")
+                if len(readme_els) > 0:
+                    readme = readme_els[0].text
+                else:
+                    readme = None
                 install_el = install_els[0]
                 packages.append(Package(self, package_el, install_el, readme=readme))
             else:
@@ -139,9 +1384,36 @@ class Dependencies(object):
 
         self.packages = packages
         self.dependencies = dependencies
+        self.install_count = install_count
 
     def single_package(self):
-        return len(self.packages) == 1
+        return self.install_count == 1
+
+    def download_urls(self):
+        urls = []
+        for package in self.packages:
+            urls.extend(package.download_urls())
+        return urls
+
+    def referenced_repos(self):
+        """ Repositories named by <repository> elements anywhere in this file,
+        mapped onto the canonical URL of the tool shed they live on.
+        """
+        referenced = [d.repo for d in self.dependencies]
+        for package in self.packages:
+            for actions in package.all_actions:
+                referenced.extend(p.repo for p in actions.action_packages)
+                for action in actions.actions:
+                    if hasattr(action, "repo"):
+                        referenced.append(action.repo)
+        repos = []
+        seen = set()
+        for repo in referenced:
+            key = (repo.prefix, repo.owner, repo.name)
+            if key not in seen:
+                seen.add(key)
+                repos.append(Repo.from_api(repo.prefix, {"owner": repo.owner, "name": repo.name}))
+        return repos
 
     def __repr__(self):
         return "Dependencies[for_repo=%s]" % self.repo
@@ -161,11 +1433,11 @@ class Dependency(object):
 
 class Actions(object):
 
-    def __init__(self, actions, os=None, architecture=None, action_packages=[]):
+    def __init__(self, actions, os=None, architecture=None, action_packages=None):
         self.os = os
         self.architecture = architecture
         self.actions = actions or []
-        self.action_packages = action_packages
+        self.action_packages = action_packages or []
 
     def first_download(self):
         for action in self.actions:
@@ -208,7 +1480,7 @@ class Action(object):
 
             return True
 
-    def to_ruby(self):
+    def to_ruby(self, extensions_used):
         action_type = self.type
         statements = []
         if action_type == "shell_command":
@@ -251,7 +1523,7 @@ class Action(object):
                     statements.append('''environment_actions += %s''' % list_str)
                 else:
                     statements.append('''environment(%s)''' % list_str)
-                self.package.extensions_used.add('ENVIRONMENT')
+                extensions_used.add('ENVIRONMENT')
         elif action_type == "chmod":
             for mod in self.mods:
                 target = shell_string(variable["target"])
@@ -575,7 +1847,6 @@ class Package(object):
         self.package_el = package_el
         self.install_el = install_el
         self.readme = readme
-        self.extensions_used = set()
         self.all_actions = self.get_all_actions()
         self.no_arch_option = self.has_no_achitecture_install()
 
@@ -608,6 +1879,10 @@ class Package(object):
         repo = self.dependencies.repo
         url = "%s/%s/%s" % (repo.tool_shed_url, repo.owner, repo.name)
         formula_builder.add_line("# Recipe auto-generate from repository %s" % url)
+        url_checker = self.dependencies.tap.url_checker
+        if url_checker:
+            for dead_url in url_checker.dead_urls(self.download_urls()):
+                formula_builder.add_line("# WARNING: download appears to be dead (%s): %s" % (url_checker.describe(dead_url), dead_url))
         if self.readme:
             formula_builder.add_line("# Tool Shed Readme:")
             for line in self.readme.split("\n"):
@@ -623,6 +1898,40 @@ class Package(object):
         formula_builder.finish_formula()
         return "%s.rb" % name, formula_builder.to_file()
 
+    def download_urls(self):
+        urls = []
+        for actions in self.all_actions:
+            for action in actions.downloads():
+                urls.append(action.text)
+        return urls
+
+    def index_entry(self):
+        repo = self.dependencies.repo
+        return {
+            "tool_shed": repo.prefix,
+            "owner": repo.owner,
+            "repository": repo.name,
+            "package": self.package_el.attrib["name"],
+            "version": self.package_el.attrib["version"],
+            "changeset_revision": getattr(repo, "changeset_revision", None),
+            "dependencies": self.dependency_names(),
+        }
+
+    def dependency_names(self):
+        packages = list(self.dependencies.dependencies)
+        for actions in self.all_actions:
+            packages.extend(actions.action_packages)
+        names = []
+        for package in packages:
+            name = self.depends_on_name(package.repo)
+            if name not in names:
+                names.append(name)
+        return names
+
+    def depends_on_name(self, repo):
+        prefix = self.dependencies.tap.tap_for(repo).prefix
+        return "%s/%s" % (prefix, repo.recipe_base_name())
+
     def get_recipe_name(self):
         repo = self.dependencies.repo
         base = repo.recipe_base_name()
@@ -666,19 +1975,17 @@ class Package(object):
         self.conditional_action_map(formula_builder, handle_actions)
 
     def pop_extensions(self, formula_builder):
-        for extension in self.extensions_used:
+        for extension in formula_builder.extensions_used:
             map(formula_builder.add_line, globals()["EXTENSION_%s" % extension].split("\n"))
 
     def populate_actions_packages(self, formula_builder, packages):
         for package in packages:
-            repo = package.repo
-            prefix = self.dependencies.tap.prefix
-            base = "%s/%s" % (prefix, repo.recipe_base_name())
+            base = self.depends_on_name(package.repo)
             formula_builder.add_line('depends_on "%s"' % base)
 
     def populate_actions(self, formula_builder, actions):
         for action in actions:
-            for line in action.to_ruby():
+            for line in action.to_ruby(formula_builder.extensions_used):
                 formula_builder.add_line(line)
 
     def actions_diff_only_by_download(self):
@@ -779,6 +2086,9 @@ class Package(object):
         else:
             url = action.text
             sha1 = self.fetch_sha1(url)
+            mirror = self.dependencies.tap.mirror
+            if mirror:
+                url = mirror.rewrite(url)
         download_line = '''url "%s"''' % url
         if action and action.type == "download_file" and not action.extract:
             download_line += ", :using => :nounzip"
@@ -788,6 +2098,10 @@ class Package(object):
         formula_builder.add_line('''sha1 "%s"''' % sha1)
 
     def fetch_sha1(self, url):
+        mirror = self.dependencies.tap.mirror
+        entry = mirror and mirror.lookup(url)
+        if entry:
+            return entry["sha1"]
         return ''  # TODO
 
     def parse_actions(self, actions):
@@ -852,22 +2166,50 @@ class Repo(object):
         )
 
     @staticmethod
-    def from_api(prefix, repo_json):
+    def from_api(prefix, repo_json, metadata=None):
+        # metadata is the result of repository_metadata() - when given, a
+        # repository without an entry has no installable revision at all.
+        includes_tool_dependencies = None
+        changeset_revision = None
+        if metadata is not None:
+            revision = metadata.get(repo_json.get("id"), {})
+            includes_tool_dependencies = revision.get("includes_tool_dependencies", False)
+            changeset_revision = revision.get("changeset_revision")
         return Repo(
             prefix=prefix,
             name=repo_json["name"],
             owner=repo_json["owner"],
             tool_shed_url=TOOLSHED_MAP[prefix],
+            type=repo_json.get("type"),
+            includes_tool_dependencies=includes_tool_dependencies,
+            changeset_revision=changeset_revision,
         )
 
-    def get_file(self, path):
-        try:
-            url = "%s/repos/%s/%s/raw-file/tip/%s" % (self.tool_shed_url, self.owner, self.name, path)
-            path, headers = urllib.urlretrieve(url)
-            return path
-        except Exception as e:
-            print e
+    def may_have_tool_dependencies(self):
+        if self.type == "repository_suite_definition":
+            return False
+        return self.includes_tool_dependencies is not False
+
+    def get_file(self, path, cache=None):
+        """ Cached path or in-memory file of path in the repository, None if
+        the repository has no such file.
+        """
+        cached_path = cache and cache.get_file(self, path)
+        if cached_path:
+            return cached_path
+        revision = getattr(self, "changeset_revision", None) or "tip"
+        url = "%s/repos/%s/%s/raw-file/%s/%s" % (self.tool_shed_url, self.owner, self.name, revision, path)
+        response = http_session().get(url, timeout=60)
+        if response.status_code == 404:
             return None
+        # Transport errors and other error statuses propagate, the file may
+        # well exist.
+        response.raise_for_status()
+        # Only complete responses are cached under the changeset.
+        cached_path = None
+        if cache and response.status_code == 200:
+            cached_path = cache.put_file(self, path, response.content)
+        return cached_path or io.BytesIO(response.content)
 
     def __repr__(self):
         return "Repository[name=%s,owner=%s]" % (self.name, self.owner)
@@ -914,6 +2256,8 @@ class FormulaBuilder(RubyBuilder):
 
     def __init__(self):
         super(FormulaBuilder, self).__init__()
+        # Extension methods (EXTENSION_*) the rendered actions rely on.
+        self.extensions_used = set()
         self.require('formula')
 
     def set_class_name(self, name):
@@ -925,15 +2269,54 @@ class FormulaBuilder(RubyBuilder):
         self.end()
 
 
+def write_atomic(path, contents):
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(contents)
+    os.rename(temp_path, path)
+
+
+def ensure_directory(path):
+    """ Create directory path (and parents), tolerating concurrent creation. """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    """ requests session (and so connection pools) shared by every fetch and
+    mirror download in the process.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+    return _http_session
+
+
 def shell(cmds, **popen_kwds):
     click.echo(cmds)
     p = subprocess.Popen(cmds, shell=True, **popen_kwds)
     return p.wait()
 
 
-def repos(tool_shed_url, name_filter=None, owner=None):
-    ts = toolshed.ToolShedInstance(url=TOOLSHED)
-    repos = ts.repositories.get_repositories()
+def repos(tool_shed_url, name_filter=None, owner=None, cache=None):
+    ts = toolshed.ToolShedInstance(url=tool_shed_url)
+    if cache:
+        repos = cache.listing(listing_name(tool_shed_url, "repositories"), ts.repositories.get_repositories)
+    else:
+        repos = ts.repositories.get_repositories()
     if owner:
         repos = [r for r in repos if r["owner"] == owner]
     if name_filter:
@@ -942,6 +2325,65 @@ def repos(tool_shed_url, name_filter=None, owner=None):
     return repos
 
 
+def repository_metadata(tool_shed_url, cache=None):
+    """ Summarize every repository's metadata revisions with one request.
+
+    Returns a dict mapping repository id to ``includes_tool_dependencies``
+    (true if any revision has them) and, when the tool shed reports revision
+    numbers, the ``changeset_revision`` of the newest such revision.
+    """
+    ts = toolshed.ToolShedInstance(url=tool_shed_url)
+    if cache:
+        revisions = cache.listing(listing_name(tool_shed_url, "revisions"), ts.repositories.repository_revisions)
+    else:
+        revisions = ts.repositories.repository_revisions()
+    metadata = {}
+    for revision in revisions:
+        summary = metadata.setdefault(revision["repository_id"], {
+            "includes_tool_dependencies": False,
+            "changeset_revision": None,
+            "numeric_revision": -1,
+        })
+        if not revision.get("includes_tool_dependencies"):
+            continue
+        summary["includes_tool_dependencies"] = True
+        numeric_revision = revision.get("numeric_revision")
+        if numeric_revision is not None and int(numeric_revision) > summary["numeric_revision"]:
+            summary["numeric_revision"] = int(numeric_revision)
+            summary["changeset_revision"] = revision["changeset_revision"]
+    return metadata
+
+
+def listing_name(tool_shed_url, kind):
+    return "%s-%s" % (urlparse.urlparse(tool_shed_url).netloc, kind)
+
+
+def current_rss():
+    """ Resident set size of this process in bytes (None if unknown). """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes (None if unknown). """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 64), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 truthy = frozenset(['true', 'yes', 'on', 'y', 't', '1'])
 falsy = frozenset(['false', 'no', 'off', 'n', 'f', '0'])
 
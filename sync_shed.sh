@@ -42,10 +42,10 @@ python "${SHED2TAP_DIRECTORY}/shed2tap.py" --git_user="${GIT_USER}" --tool_shed=
 if [ ! -n "${SHED2TAP_FILTERS}" ];
 then
     echo "Clearing out git repository working directory."
-    rm "${GIT_TARGET}"/*rb
+    rm -rf "${GIT_TARGET}"/*rb "${GIT_TARGET}"/Formula
 fi
 
-cp "${BREW_TAP_DIRECTORY}"/* "${GIT_TARGET}"
+cp -R "${BREW_TAP_DIRECTORY}"/* "${GIT_TARGET}"
 
 cd "${GIT_TARGET}"
 